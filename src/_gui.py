@@ -18,6 +18,8 @@ def main():
             util.send_finish_signal()
             return
         
+        # Look up all releases concurrently while the update check waits for its own.
+        util.prefetch_releases(settings.prerelease)
         version.check_update()
         util.run_widget(patcher_widget)
     except Exception as e:
@@ -12,6 +12,10 @@ from settings import settings, pc, filter_mdb_jsons
 import math
 import json
 import re
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
@@ -85,25 +89,42 @@ def _set_value_in_table(key, value):
 def _get_version_from_table():
     return _get_value_from_table("version")
 
+def _get_meta_fingerprint():
+    if not os.path.exists(util.META_PATH):
+        util.raise_database_not_found(util.META_PATH)
+
+    fingerprint = []
+    for path in (util.META_PATH, util.META_PATH + util.META_BACKUP_SUFFIX):
+        stat = os.stat(path)
+        fingerprint.append([stat.st_size, stat.st_mtime_ns])
+    return fingerprint
+
 def _is_meta_updated():
     if not _is_meta_patched():
         return False
 
-    cur_hashes = set()
-    bak_hashes = set()
+    # Only compare the databases when either file changed since the last check.
+    fingerprint = _get_meta_fingerprint()
+    cached = settings.meta_updated_cache
+    if cached and cached[0] == fingerprint:
+        return cached[1]
 
     with util.MetaConnection() as (conn, cursor):
-        cursor.execute("SELECT h from a;")
-        cur_hashes = set([row[0] for row in cursor.fetchall()])
+        cursor.execute("ATTACH DATABASE ? AS bak;", (util.META_PATH + util.META_BACKUP_SUFFIX,))
 
-    with util.MetaBackupConnection() as (conn, cursor):
-        cursor.execute("SELECT h from a;")
-        bak_hashes = set([row[0] for row in cursor.fetchall()])
+        cursor.execute("SELECT (SELECT COUNT(DISTINCT h) FROM main.a), (SELECT COUNT(DISTINCT h) FROM bak.a);")
+        cur_count, bak_count = cursor.fetchone()
 
-    if cur_hashes != bak_hashes:
-        return True
+        meta_is_updated = cur_count != bak_count
+        if not meta_is_updated:
+            cursor.execute("SELECT EXISTS (SELECT h FROM main.a EXCEPT SELECT h FROM bak.a);")
+            meta_is_updated = bool(cursor.fetchone()[0])
 
-    return False
+        cursor.execute("DETACH DATABASE bak;")
+
+    settings.meta_updated_cache = [fingerprint, meta_is_updated]
+
+    return meta_is_updated
 
 def _is_meta_patched():
     bak_path = util.META_PATH + util.META_BACKUP_SUFFIX
@@ -181,55 +202,155 @@ def get_current_patch_ver():
     return cur_patch_ver, cur_dll_ver
 
 
+# Translatable MDB tables.
+# table: (key columns, text column)
+# The last key column is the index used inside the JSON files,
+# any preceding key columns are taken from the JSON's subfolders.
+MDB_TABLES = {
+    "text_data": (("category", "index"), "text"),
+    "race_jikkyo_message": (("id",), "message"),
+}
+
+MDB_STAGING_PREFIX = util.TABLE_PREFIX + "_staging_"
+
+
+def _get_mdb_entry_text(entry):
+    if entry.get('processed'):
+        return entry['processed']
+    if entry.get('text'):
+        return entry['text']
+    return None
+
+
+def _stage_mdb_json(mdb_json, key, table_rows):
+    table = key[0]
+    key_columns, _ = MDB_TABLES[table]
+    path_keys = key[1:len(key_columns)]
+
+    data = util.load_json(mdb_json)
+
+    rows = table_rows.setdefault(table, [])
+    for index, entry in data.items():
+        text = _get_mdb_entry_text(entry)
+
+        if not text:
+            print(f"Skipping {table} {index} - No text found")
+            continue
+
+        rows.append(path_keys + (index, text))
+
+
+def _apply_staged_rows(cursor, table, rows):
+    key_columns, text_column = MDB_TABLES[table]
+    staging_table = MDB_STAGING_PREFIX + table
+
+    columns = ", ".join(f"`{column}`" for column in key_columns + (text_column,))
+    join = " AND ".join(f"{table}.`{column}` = {staging_table}.`{column}`" for column in key_columns)
+
+    cursor.execute(f"DROP TABLE IF EXISTS temp.{staging_table};")
+    cursor.execute(f"CREATE TEMP TABLE {staging_table} ({columns});")
+    cursor.executemany(
+        f"INSERT INTO {staging_table} VALUES ({','.join(['?'] * (len(key_columns) + 1))});",
+        rows
+    )
+
+    cursor.execute(f"SELECT COUNT(*) FROM {staging_table} WHERE EXISTS (SELECT 1 FROM {table} WHERE {join});")
+    matched = cursor.fetchone()[0]
+
+    cursor.execute(
+        f"""UPDATE {table} SET `{text_column}` = {staging_table}.`{text_column}` FROM {staging_table} WHERE {join};"""
+    )
+
+    cursor.execute(f"DROP TABLE temp.{staging_table};")
+
+    return matched, len(rows) - matched
+
+
+def _get_mdb_row_hash(cursor, key):
+    # Hash the current game rows covered by a JSON, to detect game updates.
+    table = key[0]
+    key_columns, text_column = MDB_TABLES[table]
+    scope = tuple(zip(key_columns, key[1:len(key_columns)]))
+
+    where = ""
+    if scope:
+        where = "WHERE " + " AND ".join(f"`{column}` = ?" for column, _ in scope)
+
+    columns = ", ".join(f"`{column}`" for column in key_columns + (text_column,))
+    order = ", ".join(f"`{column}`" for column in key_columns)
+
+    cursor.execute(
+        f"SELECT {columns} FROM {table} {where} ORDER BY {order};",
+        tuple(value for _, value in scope)
+    )
+
+    hasher = hashlib.sha256()
+    for row in cursor:
+        hasher.update(repr(row).encode('utf-8'))
+    return hasher.hexdigest()
+
+
+def _load_mdb_hashes(cursor):
+    cursor.execute(f"CREATE TABLE IF NOT EXISTS {util.MDB_HASH_TABLE} (path TEXT PRIMARY KEY, json_hash TEXT, row_hash TEXT);")
+    cursor.execute(f"SELECT path, json_hash, row_hash FROM {util.MDB_HASH_TABLE};")
+    return {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+
+
 def import_mdb():
     mdb_jsons = util.get_tl_mdb_jsons()
     mdb_jsons = filter_mdb_jsons(mdb_jsons)
 
-    with util.MDBConnection() as (conn, cursor):
-        for mdb_json in util.tqdm(mdb_jsons, desc="Importing MDB"):
+    with util.MDBConnection(settings.args.sqlite_profile) as (conn, cursor):
+        stored_hashes = _load_mdb_hashes(cursor)
+
+        # Collect all rows per table first, so each table is updated in one go.
+        # JSONs that did not change since the last import, and whose game rows
+        # are still as we left them, are skipped.
+        table_rows = {}
+        changed = []
+        for mdb_json in util.tqdm(mdb_jsons, desc="Reading MDB TLs"):
             key = util.split_mdb_path(mdb_json)
             table = key[0]
 
+            if table not in MDB_TABLES:
+                print(f"Skipping {mdb_json} - Unsupported table {table}")
+                continue
+
+            path = "/".join(key)
+            json_hash = util.get_file_hash(mdb_json)
+
+            stored = stored_hashes.get(path)
+            if stored and stored[0] == json_hash and stored[1] == _get_mdb_row_hash(cursor, key):
+                continue
+
+            _stage_mdb_json(mdb_json, key, table_rows)
+            changed.append((path, key, json_hash))
+
+        if not changed:
+            print("MDB is up to date.")
+            return
+
+        print(f"Importing {len(changed)} of {len(mdb_jsons)} MDB files.")
+
+        cursor.execute("BEGIN;")
+
+        for table, rows in table_rows.items():
             # Backup the table
             cursor.execute(f"CREATE TABLE IF NOT EXISTS {util.TABLE_BACKUP_PREFIX}{table} AS SELECT * FROM {table};")
 
-            # print(f"Importing {table} {category}")
-            data = util.load_json(mdb_json)
+            if not rows:
+                continue
 
-            for index, entry in data.items():
-                text = None
-                if entry.get('processed'):
-                    text = entry['processed']
-                elif entry.get('text'):
-                    text = entry['text']
-                
-                if not text:
-                    print(f"Skipping {table} {index} - No text found")
-                    continue
+            matched, missed = _apply_staged_rows(cursor, table, rows)
+            print(f"{table}: {matched} rows updated, {missed} rows not found")
 
-                ## Vars that can be used:
-                # text
-                # table
-                # key (Holds table and subcategories)
-                # index
-                
-                match table:
-                    # TODO: Implement other tables
-                    case "text_data":
-                        category = key[1]
-                        cursor.execute(
-                            f"""UPDATE {table} SET text = ? WHERE category = ? and `index` = ?;""",
-                            (text, category, index)
-                        )
-                    case "race_jikkyo_message":
-                        cursor.execute(
-                            f"""UPDATE {table} SET message = ? WHERE id = ?;""",
-                            (text, index)
-                        )
+        cursor.executemany(
+            f"INSERT OR REPLACE INTO {util.MDB_HASH_TABLE} (path, json_hash, row_hash) VALUES (?, ?, ?);",
+            [(path, json_hash, _get_mdb_row_hash(cursor, key)) for path, key, json_hash in changed]
+        )
 
         conn.commit()
-        cursor.execute("VACUUM;")
-        conn.commit()
+        util.reclaim_space(conn, cursor, settings.vacuum_strategy)
 
     print("Import complete.")
 
@@ -252,155 +373,205 @@ def backup_meta_db():
     shutil.copy(util.META_PATH, util.META_PATH + util.META_BACKUP_SUFFIX)
 
 
-def clean_asset_backups():
-    asset_backups = glob.glob(util.DATA_PATH + "\\**\\*.bak", recursive=True)
-    print(f"Amount of backups to revert: {len(asset_backups)}")
-    for asset_backup in asset_backups:
-        asset_path = asset_backup.rsplit(".", 1)[0]
-        if not os.path.exists(asset_path):
-            print(f"Deleting {asset_backup}")
-            os.remove(asset_backup)
-        else:
-            shutil.move(asset_backup, asset_path)
-    # print("Done")
+# Threads used to restore asset backups.
+RESTORE_WORKERS = 8
+
+def restore_asset_backup(asset_backup, meta_index):
+    asset_path = asset_backup.rsplit(".", 1)[0]
+
+    # The original is moved to the backup while patching, so a missing asset
+    # only means it's gone when the game doesn't know its hash anymore.
+    if not os.path.exists(asset_path) and not meta_index.get_row(os.path.basename(asset_path)):
+        os.remove(asset_backup)
+        return False
+
+    os.replace(asset_backup, asset_path)
+    return True
+
+
+def clean_asset_backups(keep=frozenset()):
+    # Restores the original of every patched asset, except for the backups in keep.
+    asset_backups = util.get_asset_backups()
+
+    if asset_backups is None:
+        # No manifest yet, look for backups made by older versions.
+        asset_backups = glob.glob(util.DATA_PATH + "\\**\\*.bak", recursive=True)
+
+    asset_backups = [asset_backup for asset_backup in asset_backups if os.path.normpath(asset_backup) not in keep]
+
+    # Backups in the manifest may not have been made if patching was interrupted.
+    existing_backups = [asset_backup for asset_backup in asset_backups if os.path.exists(asset_backup)]
+
+    print(f"Amount of backups to revert: {len(existing_backups)}")
+
+    if existing_backups:
+        # Load the index here, its connection can't be shared with the threads.
+        meta_index = util.get_meta_index()
+
+        with ThreadPoolExecutor(max_workers=RESTORE_WORKERS) as executor:
+            restored = list(executor.map(lambda asset_backup: restore_asset_backup(asset_backup, meta_index), existing_backups))
+
+        deleted = restored.count(False)
+        if deleted:
+            print(f"Deleted {deleted} backups of assets no longer in the game")
+
+    util.remove_asset_backups(asset_backups)
+
 
 def create_new_image_from_path_id(asset_bundle, path_id, diff_path):
     # Read the original texture
     texture_object = asset_bundle.assets[0].files[path_id]
     texture_read = texture_object.read()
+
+    # Read the diff texture
+    # Read into a bytearray, so the diff can be turned into the result without a copy.
+    diff_bytes = bytearray(os.path.getsize(diff_path))
+    with open(diff_path, "rb") as f:
+        f.readinto(diff_bytes)
+
+    if util.is_rgba_diff(diff_bytes):
+        # Diff of the raw pixels, no PNG encoding needed.
+        return util.apply_rgba_diff(texture_read.image, diff_bytes), texture_read
+
+    # Older translation releases diff the texture as a PNG file.
     source_bytes_buffer = io.BytesIO()
     texture_read.image.save(source_bytes_buffer, format="PNG")
     source_bytes_buffer.seek(0)
     source_bytes = source_bytes_buffer.read()
     source_bytes_buffer.close()
-
-    # Read the diff texture
-    with open(diff_path, "rb") as f:
-        diff_bytes = f.read()
     
     # Apply the diff
-    new_bytes = util.apply_diff(source_bytes, diff_bytes)
-    # max_len = max(len(diff_bytes), len(source_bytes))
-
-    # diff_bytes = diff_bytes.ljust(max_len, b'\x00')
-    # source_bytes = source_bytes.ljust(max_len, b'\x00')
+    new_bytes = util.apply_diff(source_bytes, diff_bytes, in_place=True)
 
-    # new_bytes = util.xor_bytes(diff_bytes, source_bytes)
-
-    return new_bytes, texture_read
+    return Image.open(io.BytesIO(new_bytes)), texture_read
 
 def set_group_0(metadatas):
     # Change asset group so it doesn't get deleted.
-    with util.MetaConnection() as (conn, cursor):
-        # Change group to 0 if it's currently 1.
-        for metadata in metadatas:
-            asset_hash = metadata['hash']
-            cursor.execute("UPDATE a SET g = 0 WHERE h = ? AND g = 1;", (asset_hash,))
-        conn.commit()
+    for metadata in metadatas:
+        util.queue_meta_write('keep', metadata['hash'])
+
+# Assets already written by the current group of jobs in this worker.
+_REWRITTEN_ASSETS = set()
 
-def handle_backup(asset_hash, force=False):
+def handle_backup(asset_hash):
+    # Returns the path to write the patched asset to, and the path to read the asset from.
     asset_path = util.get_asset_path(asset_hash)
     asset_path_bak = asset_path + ".bak"
 
+    if asset_hash in _REWRITTEN_ASSETS:
+        # An earlier job patched this asset, build on top of its changes.
+        return asset_path, asset_path
+
+    if os.path.exists(asset_path_bak):
+        return asset_path, asset_path_bak
+
     if not os.path.exists(asset_path):
         # Try to download the missing asset
-        row = None
-        with util.MetaConnection() as (conn, cursor):
-            cursor.execute("SELECT i FROM a WHERE h = ?;", (asset_hash,))
-            row = cursor.fetchone()
-
-        if not row:
+        if not util.get_meta_index().get_row(asset_hash):
             print(f"Asset not found: {asset_hash} - Skipping")
-            return None
+            return None, None
 
         # Download the asset
         # print(f"\nAsset {asset_hash} not found. Downloading.")
         util.download_asset(asset_hash, no_progress=True)
 
-    if not os.path.exists(asset_path_bak):
-        shutil.copy(asset_path, asset_path_bak)
-    elif force:
-        shutil.copy(asset_path_bak, asset_path)
+    # The original is only moved to the backup once the patched asset is written.
+    return asset_path, asset_path
 
-    return asset_path
+@contextmanager
+def patched_asset_file(asset_path):
+    # Yields a temporary path to write the patched asset to. Only when that succeeded,
+    # the original is moved to its backup and the patched file takes its place,
+    # so a failing job leaves the game's file untouched.
+    tmp_path = asset_path + ".tmp"
+    try:
+        yield tmp_path
+
+        asset_path_bak = asset_path + ".bak"
+        if not os.path.exists(asset_path_bak):
+            try:
+                os.replace(asset_path, asset_path_bak)
+            except OSError:
+                shutil.copy(asset_path, asset_path_bak)
+
+        os.replace(tmp_path, asset_path)
+        _REWRITTEN_ASSETS.add(os.path.basename(asset_path))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def write_patched_asset(asset_path, data):
+    with patched_asset_file(asset_path) as tmp_path:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
 
 def _import_texture(asset_metadata):
     hash = asset_metadata['hash']
-    asset_path = handle_backup(hash)
+    asset_path, source_path = handle_backup(hash)
 
     if not asset_path:
         return
     
     # print(f"Replacing {os.path.basename(asset_path)}")
-    asset_bundle, _ = unity.load_assetbundle(asset_path, hash)
+    asset_bundle, _ = unity.load_assetbundle(source_path, hash)
     
     for texture_data in asset_metadata['textures']:
         path_id = texture_data['path_id']
         diff_path = os.path.join(util.ASSETS_FOLDER, asset_metadata['file_name'], texture_data['name'] + ".diff")
 
-        new_bytes, texture_read = create_new_image_from_path_id(asset_bundle, path_id, diff_path)
-
-        # Create new image
-        new_image_buffer = io.BytesIO()
-        new_image_buffer.write(new_bytes)
-        new_image_buffer.seek(0)
-        new_image = Image.open(new_image_buffer)
+        new_image, texture_read = create_new_image_from_path_id(asset_bundle, path_id, diff_path)
 
         # Replace the image
         texture_read.m_TextureFormat = TextureFormat.BC7
         texture_read.image = new_image
         texture_read.save()
 
-        new_image_buffer.close()
+        new_image.close()
     
-    with open(asset_path, "wb") as f:
-        f.write(asset_bundle.file.save(packer="original"))
-
-def import_textures(texture_asset_metadatas):
-    print(f"Replacing {len(texture_asset_metadatas)} textures.")
-    texture_asset_metadatas = [a[0] for a in texture_asset_metadatas]
-
-    with util.UmaPool() as pool:
-        _ = list(util.tqdm(pool.imap_unordered(_import_texture, texture_asset_metadatas, chunksize=16), total=len(texture_asset_metadatas), desc="Importing textures"))
-
+    write_patched_asset(asset_path, asset_bundle.file.save(packer="original"))
 
 def _import_flash(flash_metadata):
     hash = flash_metadata['hash']
-    asset_path = handle_backup(hash)
+    asset_path, source_path = handle_backup(hash)
 
     if not asset_path:
-        return
+        return 0, 0
     
-    asset_bundle, _ = unity.load_assetbundle(asset_path, hash)
+    asset_bundle, _ = unity.load_assetbundle(source_path, hash)
+
+    unmatched_ids = 0
+    unmatched_names = 0
 
     for path_id, mpl_dict in flash_metadata['data'].items():
         obj = asset_bundle.assets[0].files[int(path_id)]
         tree = obj.read_typetree()
 
+        # Index the motion parameters by id. Reversed, so the first match wins on duplicates.
+        mp_index = {mp_data['_id']: mp_data for mp_data in reversed(tree['_motionParameterGroup']['_motionParameterList'])}
+
         for mpl_id, tpl_dict in mpl_dict.items():
+            mp_data = mp_index.get(mpl_id)
+            if mp_data is None:
+                unmatched_ids += 1
+                continue
+
+            tp_index = {tp_dict['_objectName']: tp_dict for tp_dict in reversed(mp_data['_textParamList'])}
+
             for tpl_name, tp_data in tpl_dict.items():
-                # Find textparameter data.
-                for mp_data in tree['_motionParameterGroup']['_motionParameterList']:
-                    if mp_data['_id'] == mpl_id:
-                        for tp_dict in mp_data['_textParamList']:
-                            if tp_dict['_objectName'] == tpl_name:
-                                # Replace textparameter data.
-                                tp_dict.update(tp_data)
-                                break
-                        break
+                tp_dict = tp_index.get(tpl_name)
+                if tp_dict is None:
+                    unmatched_names += 1
+                    continue
+
+                # Replace textparameter data.
+                tp_dict.update(tp_data)
         
         obj.save_typetree(tree)
 
-    with open(asset_path, "wb") as f:
-        f.write(asset_bundle.file.save(packer="original"))
+    write_patched_asset(asset_path, asset_bundle.file.save(packer="original"))
 
+    return unmatched_ids, unmatched_names
 
-def import_flash(flash_metadatas):
-    print(f"Replacing {len(flash_metadatas)} flash files.")
-    flash_metadatas = [a[0] for a in flash_metadatas]
-
-    for flash_metadata in util.tqdm(flash_metadatas, desc="Import. flash TLs"):
-        _import_flash(flash_metadata)
 
 def set_clip_length(root, clip_asset_path_id, length_diff):
     clip_asset = root.assets_file.files[clip_asset_path_id]
@@ -409,16 +580,20 @@ def set_clip_length(root, clip_asset_path_id, length_diff):
     clip_asset.save_typetree(clip_tree)
 
 
+def _get_ruby_file_name(file_name):
+    return file_name.replace("storytimeline", "ast_ruby").replace("hometimeline_", "ast_ruby_hometimeline_")
+
+
 def _import_story(story_data):
     hash = story_data['hash']
-    bundle_path = handle_backup(hash, force=True)
+    bundle_path, source_path = handle_backup(hash)
 
     if not bundle_path:
         print(f"\nStory not found: {story_data['file_name']} {hash} - Skipping")
         return
     # print(f"Importing {os.path.basename(bundle_path)}")
 
-    asset_bundle, root = unity.load_assetbundle(bundle_path, hash)
+    asset_bundle, root = unity.load_assetbundle(source_path, hash)
 
     tree = root.read_typetree()
 
@@ -506,21 +681,18 @@ def _import_story(story_data):
     tree['Length'] = sum([block_data['BlockLength'] for block_data in tree['BlockList']])
     root.save_typetree(tree)
 
-    with open(bundle_path, "wb") as f:
-        f.write(asset_bundle.file.save(packer="original"))
+    write_patched_asset(bundle_path, asset_bundle.file.save(packer="original"))
     
     # Handle ruby text.
-    ruby_file_name = file_name.replace("storytimeline", "ast_ruby").replace("hometimeline_", "ast_ruby_hometimeline_")
-    with util.MetaConnection() as (conn, cursor):
-        cursor.execute("SELECT h FROM a WHERE n = ?;", (ruby_file_name,))
-        ruby_hash = cursor.fetchone()
+    ruby_file_name = _get_ruby_file_name(file_name)
+    ruby_hash = util.get_meta_index().get_hash(ruby_file_name)
     
     if not ruby_hash:
         # No ruby asset for this story.
         return
 
-    ruby_path = handle_backup(ruby_hash[0])
-    ruby_bundle, _ = unity.load_assetbundle(ruby_path, ruby_hash[0])
+    ruby_path, ruby_source_path = handle_backup(ruby_hash)
+    ruby_bundle, _ = unity.load_assetbundle(ruby_source_path, ruby_hash)
 
     for obj in ruby_bundle.assets[0].objects.values():
         tree = obj.read_typetree()
@@ -529,76 +701,311 @@ def _import_story(story_data):
         tree['DataArray'] = []
         obj.save_typetree(tree)
 
-    with open(ruby_path, "wb") as f:
-        f.write(ruby_bundle.file.save(packer="original"))
-
+    write_patched_asset(ruby_path, ruby_bundle.file.save(packer="original"))
 
-def import_stories(story_datas):
-    #TODO: Increase chunk size (maybe 16?) when more stories are added.
-    story_datas = [a[0] for a in story_datas]
-    with util.UmaPool() as pool:
-        _ = list(util.tqdm(pool.imap_unordered(_import_story, story_datas, chunksize=8), total=len(story_datas), desc="Importing stories"))
 
-    # print(f"Replacing {len(story_datas)} stories.")
-    # for story_data in story_datas:
-    #     _import_story(story_data)
+def _import_xor(xor_data):
+    diff_path = os.path.join(util.ASSETS_FOLDER, xor_data['file_name'] + ".diff")
 
+    if not os.path.exists(diff_path):
+        print(f"Diff not found in TL files: {diff_path} - Skipping")
+        return
 
-def _import_xor(xor_data):
-    asset_path = handle_backup(xor_data['hash'], force=True)
+    asset_path, source_path = handle_backup(xor_data['hash'])
 
     if not asset_path:
         return
-    
-    diff_path = os.path.join(util.ASSETS_FOLDER, xor_data['file_name'] + ".diff")
 
-    if not os.path.exists(diff_path):
-        print(f"Diff not found in TL files: {diff_path} - Skipping")
+    with patched_asset_file(asset_path) as tmp_path:
+        util.apply_diff_file(source_path, diff_path, tmp_path)
+
+
+# Rough ratio between the memory needed to patch an asset and its file size.
+ASSET_JOB_MEMORY_FACTOR = 4
+
+# Patch customization setting, asset type and worker function for each kind of asset.
+ASSET_JOB_TYPES = (
+    ("flash", 'flash', _import_flash),
+    ("textures", 'texture', _import_texture),
+    ("story", 'story', _import_story),
+    ("videos", 'movie', _import_xor),
+)
+
+
+def _get_asset_output_hashes(asset_type, asset_data, meta_index):
+    # Hashes of the game assets written by a job.
+    asset_hashes = [asset_data['hash']]
+
+    if asset_type == 'story':
+        ruby_hash = meta_index.get_hash(_get_ruby_file_name(asset_data['file_name']))
+        if ruby_hash:
+            asset_hashes.append(ruby_hash)
+
+    # Assets unknown to the game are skipped when patching.
+    return [asset_hash for asset_hash in asset_hashes if meta_index.get_row(asset_hash)]
+
+
+def _get_asset_diff_paths(asset_type, asset_data):
+    if asset_type == 'texture':
+        return [os.path.join(util.ASSETS_FOLDER, asset_data['file_name'], texture_data['name'] + ".diff") for texture_data in asset_data['textures']]
+    if asset_type == 'movie':
+        return [os.path.join(util.ASSETS_FOLDER, asset_data['file_name'] + ".diff")]
+    return []
+
+
+def _get_asset_fingerprint(asset_type, asset_data, output_hashes, tl_manifest):
+    # Covers everything a patched asset is made from: the original assets, the translation and the patcher.
+    hasher = hashlib.sha256()
+    hasher.update(f"{version.version_to_string(version.VERSION)}|{asset_type}|{','.join(output_hashes)}|".encode('utf-8'))
+    hasher.update(json.dumps(asset_data, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+
+    for diff_path in _get_asset_diff_paths(asset_type, asset_data):
+        hasher.update(util.get_tl_file_fingerprint(diff_path, tl_manifest).encode('utf-8'))
+
+    return hasher.hexdigest()
+
+
+# Assumed size of an asset that isn't downloaded yet and whose size the meta DB doesn't have.
+DEFAULT_ASSET_SIZE = 1024**2
+
+def _get_asset_size(asset_hash, meta_index):
+    size = meta_index.get_size(asset_hash)
+    if size:
+        return size
+
+    # Older meta DBs have no sizes, use the file on disk instead.
+    asset_path = util.get_asset_path(asset_hash)
+    for path in (asset_path + ".bak", asset_path):
+        if os.path.exists(path):
+            return os.path.getsize(path)
+
+    return DEFAULT_ASSET_SIZE
+
+
+def _get_asset_jobs(asset_dict):
+    meta_index = util.get_meta_index()
+    tl_manifest = util.load_tl_manifest()
+
+    jobs = []
+    for pc_key, asset_type, func in ASSET_JOB_TYPES:
+        if not pc(pc_key):
+            continue
+
+        for asset_data, _ in asset_dict.get(asset_type, []):
+            output_hashes = _get_asset_output_hashes(asset_type, asset_data, meta_index)
+            jobs.append({
+                'type': asset_type,
+                'func': func,
+                'data': asset_data,
+                'hashes': output_hashes,
+                # Bundle size is a good enough estimate of how long an asset takes to patch.
+                'cost': sum(_get_asset_size(asset_hash, meta_index) for asset_hash in output_hashes),
+                'fingerprint': _get_asset_fingerprint(asset_type, asset_data, output_hashes, tl_manifest),
+            })
+
+    return jobs
+
+
+def _group_asset_jobs(jobs):
+    # Jobs that write to the same asset are grouped, so one worker runs them one after
+    # another instead of several workers racing on the same file.
+    groups = []
+    group_of_hash = {}
+
+    for index, job in enumerate(jobs):
+        touched = []
+        for asset_hash in job['hashes']:
+            group = group_of_hash.get(asset_hash)
+            if group is not None and not any(group is other for other in touched):
+                touched.append(group)
+
+        merged = [(index, job)]
+        for group in touched:
+            merged += group
+            groups = [other for other in groups if other is not group]
+        # Keep the original order within a group.
+        merged.sort(key=lambda item: item[0])
+        groups.append(merged)
+
+        for _, merged_job in merged:
+            for asset_hash in merged_job['hashes']:
+                group_of_hash[asset_hash] = merged
+
+    asset_groups = []
+    for group in groups:
+        group_jobs = [job for _, job in group]
+
+        hasher = hashlib.sha256()
+        for job in group_jobs:
+            hasher.update(job['fingerprint'].encode('utf-8'))
+
+        asset_groups.append({
+            'jobs': group_jobs,
+            'hashes': list(dict.fromkeys(asset_hash for job in group_jobs for asset_hash in job['hashes'])),
+            'cost': sum(job['cost'] for job in group_jobs),
+            'fingerprint': hasher.hexdigest(),
+        })
+
+    return asset_groups
+
+
+def _is_asset_up_to_date(group, fingerprints):
+    # The patched files must come from the same inputs, and be untouched since.
+    if not group['hashes']:
+        return False
+
+    for asset_hash in group['hashes']:
+        asset_path = util.get_asset_path(asset_hash)
+        stored = fingerprints.get(asset_path)
+
+        if not stored or stored[0] != group['fingerprint'] or not os.path.exists(asset_path + ".bak"):
+            return False
+
+        try:
+            stat = os.stat(asset_path)
+        except FileNotFoundError:
+            return False
+
+        if (stat.st_size, stat.st_mtime_ns) != (stored[1], stored[2]):
+            return False
+
+    return True
+
+
+def _get_asset_job_memory(asset_type, cost):
+    if asset_type == 'movie':
+        # Movies are patched in blocks.
+        return util.DIFF_BLOCK_SIZE
+    return cost * ASSET_JOB_MEMORY_FACTOR
+
+
+def _get_group_meta_index(group, meta_index):
+    # The workers only get the meta DB rows of the assets their group touches.
+    ruby_names = [_get_ruby_file_name(job['data']['file_name']) for job in group['jobs'] if job['type'] == 'story']
+    return meta_index.subset(group['hashes'], ruby_names)
+
+
+def _run_asset_group(group):
+    util.set_meta_index(group['meta_index'])
+    _REWRITTEN_ASSETS.clear()
+
+    results = []
+    try:
+        for job in group['jobs']:
+            asset_data = job['data']
+
+            start = time.perf_counter()
+            result = job['func'](asset_data)
+            results.append((job['type'], asset_data.get('file_name', asset_data['hash']), time.perf_counter() - start, result))
+    finally:
+        _REWRITTEN_ASSETS.clear()
+
+    # Fingerprint the patched files, so the next run can skip them if nothing changed.
+    fingerprints = []
+    for asset_hash in group['hashes']:
+        asset_path = util.get_asset_path(asset_hash)
+        if not os.path.exists(asset_path) or not os.path.exists(asset_path + ".bak"):
+            continue
+
+        stat = os.stat(asset_path)
+        fingerprints.append((asset_path, group['fingerprint'], stat.st_size, stat.st_mtime_ns))
+
+    return results, fingerprints
+
+
+def import_asset_jobs(groups):
+    if not groups:
+        # Nothing changed, don't start the workers.
         return
 
-    with open(diff_path, "rb") as f:
-        diff_bytes = f.read()
+    # Run every asset type in one pool, biggest first, so no worker idles
+    # between types or waits on one large asset at the end.
+    groups = sorted(groups, key=lambda group: group['cost'], reverse=True)
 
-    with open(asset_path, "rb") as f:
-        source_bytes = f.read()
+    meta_index = util.get_meta_index()
+    groups = [dict(group, meta_index=_get_group_meta_index(group, meta_index)) for group in groups]
 
-    new_bytes = util.apply_diff(source_bytes, diff_bytes)
+    job_memory = max((_get_asset_job_memory(job['type'], job['cost']) for group in groups for job in group['jobs']), default=None)
 
-    with open(asset_path, "wb") as f:
-        f.write(new_bytes)
+    type_times = {}
+    unmatched_ids = 0
+    unmatched_names = 0
+    fingerprints = []
+
+    try:
+        with util.UmaPool(settings.args.workers, job_memory=job_memory) as pool:
+            pbar = util.tqdm(total=sum(len(group['jobs']) for group in groups), desc="Patching assets", bar_format=util.TQDM_FORMAT + " {postfix}")
+            for results, group_fingerprints in pool.imap_jobs(_run_asset_group, groups):
+                fingerprints.extend(group_fingerprints)
 
+                for asset_type, file_name, elapsed, result in results:
+                    type_times[asset_type] = type_times.get(asset_type, 0) + elapsed
 
-def import_movies(movie_metadatas):
-    movie_datas = [a[0] for a in movie_metadatas]
+                    if asset_type == 'flash':
+                        unmatched_ids += result[0]
+                        unmatched_names += result[1]
 
-    set_group_0(movie_datas)
+                    pbar.set_postfix_str(f"{os.path.basename(file_name)} {elapsed:.2f}s", refresh=False)
+                    pbar.update()
+            pbar.close()
+            peak_rss = pool.peak_rss
+    finally:
+        # Also when patching fails, so the finished assets aren't redone.
+        util.save_asset_fingerprints(fingerprints)
 
-    with util.UmaPool() as pool:
-        _ = list(util.tqdm(pool.imap_unordered(_import_xor, movie_datas, chunksize=16), total=len(movie_datas), desc="Patching videos"))
+    if unmatched_ids or unmatched_names:
+        print(f"Flash: {unmatched_ids} motion parameter ids and {unmatched_names} text parameters not found in the game files.")
+
+    if settings.args.timing:
+        for asset_type, total in type_times.items():
+            print(f"Patching {asset_type} assets took {total:.2f}s of worker time")
+        print(f"Peak worker memory: {peak_rss / 1024**2:.0f} MB")
 
-    # print(f"Replacing {len(xor_datas)} xor files.")
-    # for xor_data in xor_datas:
-    #     _import_xor(xor_data)
 
 def import_assets():
-    clean_asset_backups()
     revert_meta_db()
     backup_meta_db()
 
     if not pc("flash") and not pc("textures") and not pc("story") and not pc("videos"):
+        clean_asset_backups()
         print("Skipping assets.")
         return
 
-    asset_dict = util.get_assets_type_dict()
+    asset_dict = util.get_assets_type_dict(settings.args.workers)
+
+    jobs = _get_asset_jobs(asset_dict)
+    groups = _group_asset_jobs(jobs)
+
+    # Assets patched by an earlier run from the same inputs are left as they are.
+    stored_fingerprints = util.get_asset_fingerprints()
+    unchanged_groups = []
+    changed_groups = []
+    for group in groups:
+        if _is_asset_up_to_date(group, stored_fingerprints):
+            unchanged_groups.append(group)
+        else:
+            changed_groups.append(group)
+
+    unchanged_paths = [util.get_asset_path(asset_hash) for group in unchanged_groups for asset_hash in group['hashes']]
+    clean_asset_backups({os.path.normpath(asset_path + ".bak") for asset_path in unchanged_paths})
+    util.save_asset_fingerprints([(asset_path,) + stored_fingerprints[asset_path] for asset_path in unchanged_paths], replace=True)
 
-    if pc("flash"):
-        import_flash(asset_dict.get('flash', []))
-    if pc("textures"):
-        import_textures(asset_dict.get('texture', []))
-    if pc("story"):
-        import_stories(asset_dict.get('story', []))
-    if pc("videos"):
-        import_movies(asset_dict.get('movie', []))
+    for pc_key, asset_type, _ in ASSET_JOB_TYPES:
+        if pc(pc_key):
+            changed_count = sum(1 for group in changed_groups for job in group['jobs'] if job['type'] == asset_type)
+            unchanged_count = sum(1 for group in unchanged_groups for job in group['jobs'] if job['type'] == asset_type)
+            print(f"Replacing {changed_count} {asset_type} assets ({unchanged_count} unchanged).")
+
+    try:
+        set_group_0([job['data'] for job in jobs if job['type'] == 'movie'])
+
+        # Download missing assets up front, so the workers only have to patch.
+        util.prefetch_assets([asset_hash for group in changed_groups for asset_hash in group['hashes']])
+        util.add_asset_backups([asset_hash for group in groups for asset_hash in group['hashes']])
+
+        import_asset_jobs(changed_groups)
+    finally:
+        util.flush_meta_writes(settings.args.sqlite_profile)
 
 
 def _import_jpdict():
@@ -1027,28 +1434,36 @@ def main(dl_latest=False, dll_name='carotenify.dll', ignore_filesize=False):
 
     ver = None
     if dl_latest:
-        ver = util.download_latest(ignore_filesize, settings.prerelease)
+        with util.timed("Downloading translations", settings.args.timing):
+            ver = util.download_latest(ignore_filesize, settings.prerelease)
 
-    settings.client_version = version.VERSION
-    settings.install_started = True
-    settings.customization_changed = False
+    with settings.batch():
+        settings.client_version = version.VERSION
+        settings.install_started = True
+        settings.customization_changed = False
 
     mark_mdb_translated(ver)
 
-    import_mdb()
+    timing = settings.args.timing
+
+    with util.timed("Importing MDB", timing):
+        import_mdb()
 
     if pc("assembly"):
-        import_assembly()
+        with util.timed("Importing assembly", timing):
+            import_assembly()
     
     download_dll(dl_latest, dll_name)
 
-    import_assets()
+    with util.timed("Importing assets", timing):
+        import_assets()
 
     if dl_latest:
         util.clean_download()
     
-    settings.install_started = False
-    settings.installed = True
+    with settings.batch():
+        settings.install_started = False
+        settings.installed = True
 
     print("=== Patching complete! ===\n")
 
@@ -1,5 +1,4 @@
 import util
-import glob
 import shutil
 import os
 import _patch
@@ -7,7 +6,11 @@ from settings import settings
 
 def revert_mdb():
     print("Reverting MDB")
-    with util.MDBConnection() as (conn, cursor):
+    with util.MDBConnection(settings.args.sqlite_profile) as (conn, cursor):
+        # Forget the imported MDB JSONs, so the next patch imports everything.
+        cursor.execute(f"DROP TABLE IF EXISTS {util.MDB_HASH_TABLE};")
+        conn.commit()
+
         # Restore tables starting with "patch_backup_"
         cursor.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name LIKE '{util.TABLE_BACKUP_PREFIX}%';")
         tables = cursor.fetchall()
@@ -38,21 +41,10 @@ def revert_mdb():
             cursor.execute(f"DROP TABLE {table};")
 
         conn.commit()
-        cursor.execute("VACUUM;")
-        conn.commit()
+        util.reclaim_space(conn, cursor, settings.vacuum_strategy)
 
 def revert_assets():
-    asset_backups = glob.glob(util.DATA_PATH + "\\**\\*.bak", recursive=True)
-    print(f"Reverting {len(asset_backups)} assets")
-    for asset_backup in asset_backups:
-        asset_path = asset_backup.rsplit(".", 1)[0]
-        if not os.path.exists(asset_path):
-            # print(f"Deleting {asset_backup}")
-            os.remove(asset_backup)
-        else:
-            # print(f"Reverting {asset_path}")
-            shutil.copy(asset_backup, asset_path)
-            os.remove(asset_backup)
+    _patch.clean_asset_backups()
 
 
 def revert_assembly(dl_latest=False):
@@ -142,15 +134,20 @@ def main(dl_latest=False):
     print("=== Unpatching ===")
     settings.customization_changed = False
 
-    revert_mdb()
-    revert_assets()
+    timing = settings.args.timing
+
+    with util.timed("Reverting MDB", timing):
+        revert_mdb()
+    with util.timed("Reverting assets", timing):
+        revert_assets()
     revert_assembly(dl_latest)
     _patch.revert_meta_db()
     _patch.mark_mdb_untranslated()
-    settings.install_started = False
-    settings.installed_version = None
-    settings.dll_version = None
-    settings.installed = False
+    with settings.batch():
+        settings.install_started = False
+        settings.installed_version = None
+        settings.dll_version = None
+        settings.installed = False
     print("=== Unpatch complete! ===\n")
 
 if __name__ == "__main__":
@@ -4,6 +4,8 @@ import copy
 import os
 import argparse
 import sys
+import threading
+from contextlib import contextmanager
 
 default_settings = {
     'client_version': None,
@@ -22,6 +24,8 @@ default_settings = {
     'cellar_downloaded': False,
     'first_run': True,
     'cj_orig_name': None,
+    'vacuum_strategy': 'incremental',
+    'meta_updated_cache': None,
 }
 
 class Settings:
@@ -29,6 +33,11 @@ class Settings:
 
     def __init__(self):
         self.args = self._parse_args()
+        self._lock = threading.RLock()
+        self._data = None
+        self._stat = None
+        self._dirty = False
+        self._batch_depth = 0
 
     @property
     def first_run(self):
@@ -158,15 +167,46 @@ class Settings:
     def cj_orig_name(self, value):
         self['cj_orig_name'] = value
     
+    @property
+    def vacuum_strategy(self):
+        return self['vacuum_strategy']
+
+    @vacuum_strategy.setter
+    def vacuum_strategy(self, value):
+        self['vacuum_strategy'] = value
+    
+    @property
+    def meta_updated_cache(self):
+        return self['meta_updated_cache']
+
+    @meta_updated_cache.setter
+    def meta_updated_cache(self, value):
+        self['meta_updated_cache'] = value
+    
+    def _get_stat(self):
+        try:
+            stat = os.stat(self._path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
     def _load(self):
+        # Only read the file when it was changed outside of this object.
+        # Pending batched changes are never overwritten.
+        stat = self._get_stat()
+        if self._data is not None and (self._dirty or stat == self._stat):
+            return self._data
+
         # print("Loading settings")
-        if not os.path.exists(self._path):
+        if stat is None:
             # print("Settings file not found. Using default.")
-            return copy.deepcopy(default_settings)
-        
-        with open(self._path, 'r') as f:
-            tmp = json.load(f)
+            tmp = copy.deepcopy(default_settings)
+        else:
+            with open(self._path, 'r') as f:
+                tmp = json.load(f)
         
+        self._data = tmp
+        self._stat = stat
         return tmp
     
     def _save(self, settings):
@@ -178,26 +218,52 @@ class Settings:
             else:
                 new_settings[key] = default_settings[key]
 
-        with open(self._path, 'w') as f:
+        # Write to a temporary file first, so the settings are never left half-written.
+        tmp_path = self._path + ".tmp"
+        with open(tmp_path, 'w') as f:
             json.dump(new_settings, f, indent=4)
+        os.replace(tmp_path, self._path)
+
+        self._stat = self._get_stat()
     
     def __getitem__(self, key):
         # print(f"Getting setting {key}")
-        settings = self._load()
+        with self._lock:
+            settings = self._load()
 
-        if key in settings:
-            return settings[key]
+            if key in settings:
+                return copy.deepcopy(settings[key])
         
         if key in default_settings:
-            return default_settings[key]
+            return copy.deepcopy(default_settings[key])
         
         return None
     
     def __setitem__(self, key, value):
         # print(f"Setting {key} to {value}")
-        settings = self._load()
-        settings[key] = value
-        self._save(settings)
+        with self._lock:
+            settings = self._load()
+            settings[key] = copy.deepcopy(value)
+
+            if self._batch_depth:
+                self._dirty = True
+                return
+
+            self._save(settings)
+
+    @contextmanager
+    def batch(self):
+        # Collect all settings changes made inside the block and write them once.
+        with self._lock:
+            self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._batch_depth -= 1
+                if not self._batch_depth and self._dirty:
+                    self._dirty = False
+                    self._save(self._data)
     
     def _parse_args(self):
         p = argparse.ArgumentParser()
@@ -206,6 +272,9 @@ class Settings:
         p.add_argument('-f', '--force', action='store_true', help="Force install the patch even if there's no update. DLL name as argument")
         p.add_argument('-u', '--unpatch', action='store_true', help="Uninstall the patch")
         p.add_argument('-c', '--customization', action='store_true', help="Show the customization widget")
+        p.add_argument('-t', '--timing', action='store_true', help="Print how long each patch step takes")
+        p.add_argument('-w', '--workers', type=int, default=None, help="Number of worker processes used to patch assets (default: based on CPU count and free memory)")
+        p.add_argument('--sqlite-profile', choices=util.CONNECTION_PROFILES.keys(), default='bulk', help="SQLite settings used for bulk database writes")
 
         return p.parse_args()
     
@@ -16,9 +16,14 @@ def load_assetbundle(path, hash):
     if root is None:
         # Maybe the asset is corrupted.
         # We try downloading it again.
+        asset_path = util.get_asset_path(hash)
         os.remove(path)
         util.download_asset(hash, no_progress=True, force=True)
-        shutil.copy(path, path + ".bak")
+        if path != asset_path:
+            # Loading the original from its backup, put the new download there.
+            os.replace(asset_path, path)
+        else:
+            shutil.copy(path, path + ".bak")
         asset = UnityPy.load(path)
         try:
             root = list(asset.container.values())[0].get_obj()
@@ -2,6 +2,8 @@ import sqlite3
 import os
 import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import numpy as np
 import shutil
 import zipfile
@@ -21,8 +23,14 @@ import glob
 import pyphen
 from functools import cache
 from multiprocessing.pool import Pool
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import queue
 import re
 import hashlib
+import struct
+import mmap
+from contextlib import contextmanager
 
 hyphen_dict = pyphen.Pyphen(lang='en_US')
 
@@ -47,17 +55,51 @@ def get_asset(asset_path):
     return os.path.join(unpack_dir, asset_path)
 
 
+# Memory a worker needs on top of the job itself (interpreter, UnityPy, etc.)
+# Workers don't get a copy of the meta index, only the few rows each job sends along,
+# so the index loaded in the main process doesn't count towards this.
+POOL_WORKER_MEMORY = 200 * 1024**2
+# Share of the available memory the workers may use together.
+POOL_MEMORY_FRACTION = 0.75
+# Restart workers after this many tasks, so objects leaked by UnityPy are freed.
+POOL_MAX_TASKS_PER_CHILD = 64
+
 class UmaPool(Pool):
-    def __init__(self, processes=None, *args, **kwargs):
-        # Limit processes to 12 maximum.
+    def __init__(self, processes=None, *args, job_memory=None, **kwargs):
         if not processes:
             processes = os.cpu_count() or 1
 
+            # Don't start more workers than fit in memory.
+            if job_memory:
+                memory_workers = int(get_available_memory() * POOL_MEMORY_FRACTION) // (POOL_WORKER_MEMORY + job_memory)
+                processes = max(1, min(processes, memory_workers))
+
+        # Limit processes to 12 maximum.
         # if processes > 12:
         #     processes = 12
 
+        if len(args) < 3:
+            kwargs.setdefault('maxtasksperchild', POOL_MAX_TASKS_PER_CHILD)
+
+        # Highest peak memory use of any worker that ran a job through imap_jobs.
+        self.peak_rss = 0
+
         super().__init__(processes, *args, **kwargs)
 
+    def imap_jobs(self, func, iterable, chunksize=1):
+        # Like imap_unordered, but meta DB writes queued by the workers
+        # are handed back to this process, to be flushed in one go.
+        jobs = ((func, item) for item in iterable)
+        for result, meta_writes, peak_rss in self.imap_unordered(_run_pool_job, jobs, chunksize=chunksize):
+            _META_WRITES.extend(meta_writes)
+            self.peak_rss = max(self.peak_rss, peak_rss)
+            yield result
+
+
+def _run_pool_job(job):
+    func, item = job
+    return func(item), take_meta_writes(), get_peak_rss()
+
 
 APP_DIR = os.path.expandvars("%AppData%\\Uma-Carotene\\")
 os.makedirs(APP_DIR, exist_ok=True)
@@ -77,7 +119,10 @@ CAROTENIFY_PATY = os.path.expandvars("%TEMP%\\carotenify")
 
 TMP_FOLDER = get_asset("tmp\\")
 
-TL_PREFIX = get_asset("translations\\")
+# Translations are kept between runs, so updates only need to download changed files.
+# The unpack directory of the exe is temporary, so use the app folder instead.
+TL_PREFIX = get_asset("translations\\") if is_script else APP_DIR + "translations\\"
+TL_MANIFEST_PATH = APP_DIR + "translations_manifest.json"
 INTERMEDIATE_PREFIX = get_asset("editing\\")
 
 MDB_FOLDER = TL_PREFIX + "mdb\\"
@@ -108,6 +153,8 @@ TABLE_BACKUP_PREFIX = TABLE_PREFIX + "_bak_"
 
 META_BACKUP_TABLE = TABLE_BACKUP_PREFIX + "a"
 
+MDB_HASH_TABLE = TABLE_PREFIX + "_hashes"
+
 DLL_BACKUP_SUFFIX = ".bak"
 
 DMM_CONFIG_PATH = os.path.expandvars("%AppData%\dmmgameplayer5\dmmgame.cnf")
@@ -123,22 +170,112 @@ def string_to_version(version_string):
     
     return tuple(int(v) for v in version_string.split("."))
 
+# SQLite PRAGMA settings applied when opening a connection.
+CONNECTION_PROFILES = {
+    'default': {},
+    # For patching/reverting large amounts of rows.
+    # Trades crash safety for speed, the MDB can always be redownloaded
+    # and the meta DB is backed up before patching.
+    'bulk': {
+        'journal_mode': 'MEMORY',
+        'synchronous': 'OFF',
+        'cache_size': -256 * 1024,  # In KiB
+        'temp_store': 'MEMORY',
+        'mmap_size': 256 * 1024**2,
+    },
+}
+
+# Settings read when a connection with a profile opens, and put back before it closes.
+# The journal mode is stored in the database file, so it has to be restored.
+RESTORED_PRAGMAS = ('journal_mode', 'synchronous')
+
+def raise_database_not_found(db_path):
+    display_critical_message("No Database Found", "We couldn't find the game's database file.\n\nPlease make sure that you have finished the tutorial and the initial in-game download before running Carotene.\n\nIf you are still encoutering this issue please join our Discord server for direct help.")
+    raise GameDatabaseNotFoundException(f"Game database {db_path} not found.")
+
 class Connection:
     DB_PATH = None
 
-    def __init__(self):
+    def __init__(self, profile='default'):
         if not self.DB_PATH or not os.path.exists(self.DB_PATH):
-            display_critical_message("No Database Found", "We couldn't find the game's database file.\n\nPlease make sure that you have finished the tutorial and the initial in-game download before running Carotene.\n\nIf you are still encoutering this issue please join our Discord server for direct help.")
-            raise GameDatabaseNotFoundException(f"Game database {self.DB_PATH} not found.")
-        else:
-            self.conn = sqlite3.connect(self.DB_PATH)
+            raise_database_not_found(self.DB_PATH)
+
+        self.conn = sqlite3.connect(self.DB_PATH)
+        self.pragmas = CONNECTION_PROFILES[profile]
+        self.original_pragmas = self._read_pragmas(RESTORED_PRAGMAS) if self.pragmas else {}
+        self._apply_pragmas(self.pragmas)
+
+    def _read_pragmas(self, keys):
+        cursor = self.conn.cursor()
+        pragmas = {}
+        for key in keys:
+            cursor.execute(f"PRAGMA {key};")
+            pragmas[key] = cursor.fetchone()[0]
+        cursor.close()
+        return pragmas
+
+    def _apply_pragmas(self, pragmas):
+        cursor = self.conn.cursor()
+        for key, value in pragmas.items():
+            cursor.execute(f"PRAGMA {key} = {value};")
+            cursor.fetchall()
+        cursor.close()
 
     def __enter__(self):
-            return self.conn, self.conn.cursor()
+            self.cursor = self.conn.cursor()
+            return self.conn, self.cursor
 
     def __exit__(self, type, value, traceback):
+            if self.pragmas and not self.conn.in_transaction:
+                self._apply_pragmas(self.original_pragmas)
             self.conn.close()
 
+VACUUM_STRATEGIES = ('none', 'incremental', 'full')
+
+# Free space in the database that triggers a full VACUUM with the incremental strategy.
+VACUUM_FREELIST_THRESHOLD = 64 * 1024**2
+
+def _get_db_size(cursor):
+    cursor.execute("PRAGMA page_size;")
+    page_size = cursor.fetchone()[0]
+    cursor.execute("PRAGMA page_count;")
+    page_count = cursor.fetchone()[0]
+    cursor.execute("PRAGMA freelist_count;")
+    freelist_count = cursor.fetchone()[0]
+    return page_size * page_count, page_size * freelist_count
+
+def reclaim_space(conn, cursor, strategy='incremental'):
+    if strategy not in VACUUM_STRATEGIES:
+        raise ValueError(f"Unknown vacuum strategy: {strategy}")
+
+    if strategy == 'none':
+        return
+
+    start = time.perf_counter()
+    size_before, free_before = _get_db_size(cursor)
+
+    cursor.execute("PRAGMA auto_vacuum;")
+    auto_vacuum = cursor.fetchone()[0]
+
+    if strategy == 'full':
+        method = "VACUUM"
+        cursor.execute("VACUUM;")
+    elif auto_vacuum == 2:
+        # auto_vacuum = INCREMENTAL, free pages can be released without a rewrite.
+        method = "incremental vacuum"
+        cursor.execute("PRAGMA incremental_vacuum;")
+        cursor.fetchall()
+    elif free_before > VACUUM_FREELIST_THRESHOLD:
+        method = "VACUUM"
+        cursor.execute("VACUUM;")
+    else:
+        print(f"Skipping vacuum: {free_before / 1024**2:.1f} MB free in database.")
+        return
+    conn.commit()
+
+    size_after, _ = _get_db_size(cursor)
+    print(f"Reclaimed {(size_before - size_after) / 1024**2:.1f} MB using {method} in {time.perf_counter() - start:.1f}s.")
+
 class MDBConnection(Connection):
     DB_PATH = MDB_PATH
 
@@ -148,6 +285,102 @@ class MetaConnection(Connection):
 class MetaBackupConnection(Connection):
     DB_PATH = META_PATH + META_BACKUP_SUFFIX
 
+class MetaIndex:
+    # In-memory copy of the meta DB's asset table for fast lookups.
+    def __init__(self):
+        self.stat = self._get_stat()
+
+        with MetaConnection() as (conn, cursor):
+            cursor.execute("SELECT i, n, h, s, g FROM a;")
+            rows = cursor.fetchall()
+
+            # File sizes, if this version of the meta DB has them.
+            cursor.execute("PRAGMA table_info(a);")
+            columns = [row[1] for row in cursor.fetchall()]
+            sizes = []
+            if 'l' in columns:
+                cursor.execute("SELECT h, l FROM a;")
+                sizes = cursor.fetchall()
+
+        self.rows = {row[2]: row for row in rows}
+        self.hashes = {row[1]: row[2] for row in rows}
+        self.sizes = {asset_hash: size for asset_hash, size in sizes if size}
+
+    @staticmethod
+    def _get_stat():
+        stat = os.stat(META_PATH)
+        return stat.st_mtime_ns, stat.st_size
+
+    def is_stale(self):
+        return self._get_stat() != self.stat
+
+    def get_row(self, asset_hash):
+        # Returns (i, n, h, s, g) or None
+        return self.rows.get(asset_hash)
+
+    def get_hash(self, name):
+        return self.hashes.get(name)
+
+    def get_size(self, asset_hash):
+        return self.sizes.get(asset_hash)
+
+    def subset(self, asset_hashes, names=()):
+        # Copy with only the given assets, small enough to send to a pool worker.
+        index = MetaIndex.__new__(MetaIndex)
+        index.stat = self.stat
+        index.hashes = {name: self.hashes[name] for name in names if name in self.hashes}
+
+        asset_hashes = set(asset_hashes) | set(index.hashes.values())
+        index.rows = {asset_hash: self.rows[asset_hash] for asset_hash in asset_hashes if asset_hash in self.rows}
+        index.sizes = {asset_hash: self.sizes[asset_hash] for asset_hash in asset_hashes if asset_hash in self.sizes}
+        return index
+
+_META_INDEX = None
+
+def get_meta_index():
+    global _META_INDEX
+
+    if _META_INDEX is None or _META_INDEX.is_stale():
+        _META_INDEX = MetaIndex()
+
+    return _META_INDEX
+
+def set_meta_index(meta_index):
+    global _META_INDEX
+    _META_INDEX = meta_index
+
+# Meta DB writes that are queued and flushed together.
+META_WRITE_QUERIES = {
+    # Mark an asset as downloaded.
+    'downloaded': "UPDATE a SET s = 1 WHERE h = ? AND s = 0;",
+    # Change asset group so it doesn't get deleted.
+    'keep': "UPDATE a SET g = 0 WHERE h = ? AND g = 1;",
+}
+
+_META_WRITES = []
+
+def queue_meta_write(kind, asset_hash):
+    if kind not in META_WRITE_QUERIES:
+        raise ValueError(f"Unknown meta write: {kind}")
+    _META_WRITES.append((kind, asset_hash))
+
+def take_meta_writes():
+    writes = _META_WRITES[:]
+    _META_WRITES.clear()
+    return writes
+
+def flush_meta_writes(profile='default'):
+    writes = take_meta_writes()
+    if not writes:
+        return
+
+    with MetaConnection(profile) as (conn, cursor):
+        for kind, query in META_WRITE_QUERIES.items():
+            params = [(asset_hash,) for write_kind, asset_hash in writes if write_kind == kind]
+            if params:
+                cursor.executemany(query, params)
+        conn.commit()
+
 class GameDatabaseNotFoundException(Exception):
     pass
 
@@ -157,6 +390,44 @@ class NotEnoughSpaceException(Exception):
 class DMMConfigNotFoundException(Exception):
     pass
 
+def get_available_memory():
+    return win32api.GlobalMemoryStatusEx()['AvailPhys']
+
+def get_rss():
+    return win32process.GetProcessMemoryInfo(win32api.GetCurrentProcess())['WorkingSetSize']
+
+def get_peak_rss():
+    # Highest memory use over the whole life of the process.
+    return win32process.GetProcessMemoryInfo(win32api.GetCurrentProcess())['PeakWorkingSetSize']
+
+# How often timed() samples the memory use of the process, in seconds.
+TIMED_SAMPLE_INTERVAL = 0.05
+
+@contextmanager
+def timed(desc, enabled=True):
+    if not enabled:
+        yield
+        return
+
+    # The process peak also covers earlier phases, so sample the memory use during this one.
+    start = time.perf_counter()
+    peak_rss = [get_rss()]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(TIMED_SAMPLE_INTERVAL):
+            peak_rss[0] = max(peak_rss[0], get_rss())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        yield
+    finally:
+        done.set()
+        sampler.join()
+        peak_rss = max(peak_rss[0], get_rss())
+        print(f"{desc} took {time.perf_counter() - start:.2f}s (peak memory {peak_rss / 1024**2:.0f} MB)")
+
 def display_critical_message(title, text):
     if is_script:
         print(f"{title}: {text}")
@@ -179,14 +450,39 @@ def save_json(path, data):
     with open(path, "w", encoding='utf-8') as f:
         json.dump(data, f, indent=4, ensure_ascii=False)
 
+# Connection pool size per host, should be at least PREFETCH_WORKERS.
+HTTP_POOL_SIZE = 16
+HTTP_RETRIES = 3
+HTTP_BACKOFF_FACTOR = 0.5
+
+_SESSION = None
+
+def get_session():
+    # Shared session, so all downloads reuse connections.
+    global _SESSION
+
+    if _SESSION is None:
+        retry = Retry(
+            total=HTTP_RETRIES,
+            backoff_factor=HTTP_BACKOFF_FACTOR,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=('GET', 'HEAD'),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _SESSION = session
+
+    return _SESSION
+
 def download_json(url):
-    r = requests.get(url)
+    r = get_session().get(url)
     r.raise_for_status()
     return r.json()
 
-def xor_bytes(a, b):
-    return (np.frombuffer(a, dtype='uint8') ^ np.frombuffer(b, dtype='uint8')).tobytes()
-
 def fix_transparency(file_path, out_path=None):
     os.system(f"transparency-fix.exe {file_path}{f' {out_path}' if out_path else ''}")
 
@@ -289,28 +585,143 @@ def get_asset_and_type(path):
 def get_asset_path(asset_hash):
     return os.path.join(DATA_PATH, asset_hash[:2], asset_hash)
 
+# Every asset backup made by the patcher, so they can be restored without
+# scanning the whole data folder.
+BACKUP_MANIFEST_PATH = APP_DIR + "asset_backups.db"
+
+def _connect_backup_manifest():
+    conn = sqlite3.connect(BACKUP_MANIFEST_PATH)
+    conn.execute("CREATE TABLE IF NOT EXISTS backups (path TEXT PRIMARY KEY, hash TEXT, size INTEGER);")
+    return conn
+
+def add_asset_backups(asset_hashes):
+    # Recorded before the backups are made, so an interrupted patch can still be reverted.
+    meta_index = get_meta_index()
+    rows = [(get_asset_path(asset_hash) + ".bak", asset_hash, meta_index.get_size(asset_hash)) for asset_hash in asset_hashes]
+
+    conn = _connect_backup_manifest()
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO backups (path, hash, size) VALUES (?, ?, ?);", rows)
+    conn.close()
+
+def get_asset_backups():
+    # Returns None if there is no manifest yet.
+    if not os.path.exists(BACKUP_MANIFEST_PATH):
+        return None
+
+    conn = _connect_backup_manifest()
+    paths = [row[0] for row in conn.execute("SELECT path FROM backups;")]
+    conn.close()
+    return paths
+
+def remove_asset_backups(paths):
+    conn = _connect_backup_manifest()
+    with conn:
+        conn.executemany("DELETE FROM backups WHERE path = ?;", [(path,) for path in paths])
+    conn.close()
+
+# What each patched asset was made from, so unchanged assets can be skipped.
+ASSET_FINGERPRINTS_PATH = APP_DIR + "asset_fingerprints.db"
+
+def _connect_asset_fingerprints():
+    conn = sqlite3.connect(ASSET_FINGERPRINTS_PATH)
+    conn.execute("CREATE TABLE IF NOT EXISTS fingerprints (path TEXT PRIMARY KEY, fingerprint TEXT, size INTEGER, mtime_ns INTEGER);")
+    return conn
+
+def get_asset_fingerprints():
+    # Returns {path: (fingerprint, size, mtime_ns)}
+    conn = _connect_asset_fingerprints()
+    fingerprints = {row[0]: row[1:] for row in conn.execute("SELECT path, fingerprint, size, mtime_ns FROM fingerprints;")}
+    conn.close()
+    return fingerprints
+
+def save_asset_fingerprints(rows, replace=False):
+    # With replace, fingerprints not in rows are forgotten.
+    conn = _connect_asset_fingerprints()
+    with conn:
+        if replace:
+            conn.execute("DELETE FROM fingerprints;")
+        conn.executemany("INSERT OR REPLACE INTO fingerprints (path, fingerprint, size, mtime_ns) VALUES (?, ?, ?, ?);", rows)
+    conn.close()
+
+def load_tl_manifest():
+    try:
+        return load_json(TL_MANIFEST_PATH)
+    except FileNotFoundError:
+        return {}
+
+def get_tl_file_fingerprint(path, tl_manifest):
+    # Size and CRC32 of a translation file from the manifest,
+    # or size and modification time if it didn't come from a release zip.
+    entry = tl_manifest.get(os.path.relpath(path, TL_PREFIX).replace("\\", "/"))
+    if entry:
+        return f"{entry[0]}:{entry[1]}"
+
+    if not os.path.exists(path):
+        return "missing"
+
+    stat = os.stat(path)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
 def strings_numeric_key(item):
     if item.isnumeric():
         return int(item)
     return item
 
 
+RELEASE_CACHE_PATH = APP_DIR + "release_cache.json"
+RELEASE_CACHE_TTL = 10 * 60
+
+_RELEASE_CACHE = None
+_RELEASE_CACHE_LOCK = threading.Lock()
+
+def _fetch_json_cached(url):
+    # Release lists are cached on disk for RELEASE_CACHE_TTL seconds,
+    # after that they are revalidated with their ETag.
+    global _RELEASE_CACHE
+
+    with _RELEASE_CACHE_LOCK:
+        if _RELEASE_CACHE is None:
+            try:
+                _RELEASE_CACHE = load_json(RELEASE_CACHE_PATH)
+            except (FileNotFoundError, ValueError):
+                _RELEASE_CACHE = {}
+        entry = _RELEASE_CACHE.get(url)
+
+    if entry and time.time() - entry['time'] < RELEASE_CACHE_TTL:
+        return entry['data']
+
+    headers = {}
+    if entry and entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+
+    try:
+        r = get_session().get(url, headers=headers)
+        if r.status_code == 304 and entry:
+            data = entry['data']
+        else:
+            r.raise_for_status()
+            data = r.json()
+    except Exception:
+        if entry:
+            # Offline, but we have an older copy.
+            return entry['data']
+        raise
+
+    with _RELEASE_CACHE_LOCK:
+        _RELEASE_CACHE[url] = {'etag': r.headers.get('ETag'), 'time': time.time(), 'data': data}
+        save_json(RELEASE_CACHE_PATH, _RELEASE_CACHE)
+
+    return data
+
 def fetch_latest_github_release(username, repo, prerelease=False):
     url = f'https://umapyoi.net/api/v1/github/{username}/{repo}/releases'
     try:
-        r = requests.get(url)
-        r.raise_for_status()
-        if not (200 <= r.status_code < 300):
-            raise Exception("Umapyoi.net API request failed")
-        data = r.json()
+        data = _fetch_json_cached(url)
     except:
         # Fallback to github api
         url = f'https://api.github.com/repos/{username}/{repo}/releases'
-        r = requests.get(url)
-        r.raise_for_status()
-        if not (200 <= r.status_code < 300):
-            raise Exception("Github API request failed")
-        data = r.json()
+        data = _fetch_json_cached(url)
     cur_version = None
     cur_version_no = None
     for version in data:
@@ -332,38 +743,370 @@ def fetch_latest_github_release(username, repo, prerelease=False):
     return cur_version
 
 
-LATEST_DATA = None
-def get_latest_json(prerelease=False):
-    global LATEST_DATA
+RELEASE_REPOS = (
+    ('KevinVG207', 'Uma-Carotene-English-Patch'),
+    ('KevinVG207', 'Uma-Carotene-TL'),
+    ('KevinVG207', 'Uma-Carotenify'),
+)
+
+_RELEASE_FUTURES = {}
+_RELEASE_FUTURES_LOCK = threading.Lock()
+_RELEASE_EXECUTOR = ThreadPoolExecutor(max_workers=len(RELEASE_REPOS))
+
+def _get_release_future(username, repo, prerelease):
+    key = (username, repo, prerelease)
+    with _RELEASE_FUTURES_LOCK:
+        if key not in _RELEASE_FUTURES:
+            _RELEASE_FUTURES[key] = _RELEASE_EXECUTOR.submit(fetch_latest_github_release, username, repo, prerelease)
+        return _RELEASE_FUTURES[key]
 
-    if not LATEST_DATA:
-        LATEST_DATA = fetch_latest_github_release('KevinVG207', 'Uma-Carotene-TL', prerelease)
+def prefetch_releases(prerelease=False):
+    # Start looking up all releases at once, without waiting for them.
+    for username, repo in RELEASE_REPOS:
+        _get_release_future(username, repo, prerelease)
 
-    return LATEST_DATA
+def get_latest_release(username, repo, prerelease=False):
+    future = _get_release_future(username, repo, prerelease)
+    try:
+        return future.result()
+    except Exception:
+        # Try again on the next call.
+        with _RELEASE_FUTURES_LOCK:
+            if _RELEASE_FUTURES.get((username, repo, prerelease)) is future:
+                del _RELEASE_FUTURES[(username, repo, prerelease)]
+        raise
+
+def get_latest_json(prerelease=False):
+    return get_latest_release('KevinVG207', 'Uma-Carotene-TL', prerelease)
 
-LATEST_DLL_DATA = None
 def get_latest_dll_json(prerelease=False):
-    global LATEST_DLL_DATA
+    return get_latest_release('KevinVG207', 'Uma-Carotenify', prerelease)
 
-    if not LATEST_DLL_DATA:
-        LATEST_DLL_DATA = fetch_latest_github_release('KevinVG207', 'Uma-Carotenify', prerelease)
+# Chunk sizes used when streaming downloads.
+DOWNLOAD_CHUNK_SIZE = 1024**2
+LZ4_CHUNK_SIZE = 1024**2
 
-    return LATEST_DLL_DATA
+DOWNLOAD_RESUME_RETRIES = 3
 
-def download_file(url, path, no_progress=False):
-    with requests.get(url, stream=True) as r:
-        r.raise_for_status()
-        with open(path, "wb") as f:
-            bar_format = TQDM_FORMAT + " {n_fmt}/{total_fmt}"
-            if no_progress:
-                progress_bar = None
-            else:
-                progress_bar = tqdm(total=int(r.headers.get('Content-Length', 0)), unit='B', unit_scale=True, desc=f"Downloading", bar_format=bar_format)
-            for chunk in r.iter_content(chunk_size=8192):
-                f.write(chunk)
+class DownloadVerificationException(Exception):
+    pass
 
-                if progress_bar:
-                    progress_bar.update(len(chunk))
+def _save_download_validator(validator_path, validator):
+    # Kept next to the .part file, so a later run can ask with If-Range whether it's still the same file.
+    if validator:
+        with open(validator_path, "w", encoding='utf-8') as f:
+            f.write(validator)
+    elif os.path.exists(validator_path):
+        os.remove(validator_path)
+
+def download_file(url, path, no_progress=False, chunk_size=None, expected_size=None, expected_sha256=None):
+    # Downloads to a .part file first, which is resumed when the transfer is interrupted,
+    # and only moved into place once it is complete.
+    if not chunk_size:
+        chunk_size = DOWNLOAD_CHUNK_SIZE
+
+    part_path = path + ".part"
+    validator_path = part_path + ".etag"
+
+    # A leftover .part is only resumed if the server can confirm it's still the same file,
+    # otherwise the end of a newer release would be appended to an older one.
+    validator = None
+    if os.path.exists(part_path):
+        if os.path.exists(validator_path):
+            with open(validator_path, "r", encoding='utf-8') as f:
+                validator = f.read().strip() or None
+        if not validator:
+            os.remove(part_path)
+
+    progress_bar = None
+    total_size = None
+
+    for attempt in range(DOWNLOAD_RESUME_RETRIES + 1):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if expected_size and offset > expected_size:
+            os.remove(part_path)
+            offset = 0
+
+        headers = {}
+        if offset:
+            headers['Range'] = f'bytes={offset}-'
+            if validator:
+                # Get the whole file again if it changed in the meantime.
+                headers['If-Range'] = validator
+
+        try:
+            with get_session().get(url, stream=True, headers=headers) as r:
+                if r.status_code == 416 and offset:
+                    # Nothing left to download.
+                    break
+                r.raise_for_status()
+
+                if r.status_code != 206:
+                    offset = 0
+                validator = r.headers.get('ETag') or r.headers.get('Last-Modified')
+                total_size = None
+                if 'Content-Encoding' not in r.headers and r.headers.get('Content-Length'):
+                    total_size = offset + int(r.headers['Content-Length'])
+
+                if not no_progress:
+                    if progress_bar is None:
+                        bar_format = TQDM_FORMAT + " {n_fmt}/{total_fmt}"
+                        progress_bar = tqdm(total=total_size or 0, unit='B', unit_scale=True, desc=f"Downloading", bar_format=bar_format)
+                    progress_bar.reset(total=total_size or 0)
+                    progress_bar.update(offset)
+
+                with open(part_path, "ab" if offset else "wb", buffering=chunk_size) as f:
+                    if not offset:
+                        _save_download_validator(validator_path, validator)
+
+                    for chunk in r.iter_content(chunk_size=chunk_size):
+                        f.write(chunk)
+
+                        if progress_bar:
+                            progress_bar.update(len(chunk))
+            break
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.exceptions.Timeout) as e:
+            if attempt == DOWNLOAD_RESUME_RETRIES:
+                raise
+            print(f"\nDownload interrupted, resuming: {e}")
+
+    if progress_bar:
+        progress_bar.close()
+
+    size = os.path.getsize(part_path)
+    expected_size = expected_size or total_size
+    if expected_size and size != expected_size:
+        os.remove(part_path)
+        _save_download_validator(validator_path, None)
+        raise DownloadVerificationException(f"Downloaded {size} bytes instead of {expected_size} for {url}")
+
+    if expected_sha256 and get_file_hash(part_path) != expected_sha256.lower():
+        os.remove(part_path)
+        _save_download_validator(validator_path, None)
+        raise DownloadVerificationException(f"Checksum mismatch for {url}")
+
+    os.replace(part_path, path)
+    _save_download_validator(validator_path, None)
+    return size
+
+def print_throughput(desc, size, seconds):
+    seconds = max(seconds, 1e-6)
+    print(f"{desc} {size / 1024**2:.1f} MB in {seconds:.1f}s ({size / 1024**2 / seconds:.1f} MB/s)")
+
+class UnsafeZipMemberException(Exception):
+    pass
+
+def get_zip_member_path(out_path, filename):
+    # Refuse members that would end up outside of out_path, like "../x" or absolute paths.
+    root = os.path.realpath(out_path)
+    member_path = os.path.realpath(os.path.join(root, filename))
+    if os.path.commonpath([root, member_path]) != root:
+        raise UnsafeZipMemberException(f"Zip member {filename} is outside of {out_path}")
+    return member_path
+
+def extract_zip(zip_path, out_path, workers=None):
+    # Extract the members in parallel, every thread with its own zip handle.
+    if not workers:
+        workers = os.cpu_count() or 1
+
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        members = zip_ref.infolist()
+
+    # Create the folders up front, so threads don't race on creating them.
+    for member in members:
+        member_path = get_zip_member_path(out_path, member.filename)
+        if not member.is_dir():
+            member_path = os.path.dirname(member_path)
+        os.makedirs(member_path, exist_ok=True)
+
+    members = [member for member in members if not member.is_dir()]
+    total_size = sum(member.file_size for member in members)
+
+    # Spread large and small files over the threads.
+    members.sort(key=lambda member: member.file_size, reverse=True)
+    chunks = [members[i::workers] for i in range(workers)]
+
+    progress_bar = tqdm(total=total_size, unit='B', unit_scale=True, desc="Extracting", bar_format=TQDM_FORMAT + " {n_fmt}/{total_fmt}")
+
+    def _extract(chunk):
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            for member in chunk:
+                zip_ref.extract(member, out_path)
+                progress_bar.update(member.file_size)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(_extract, chunks))
+
+    progress_bar.close()
+    return total_size
+
+def swap_folder(new_path, final_path):
+    # Replace final_path with new_path, only removing the old files once the new ones are in place.
+    final_path = os.path.normpath(final_path)
+    old_path = final_path + ".old"
+
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+
+    if os.path.exists(final_path):
+        os.rename(final_path, old_path)
+
+    os.rename(new_path, final_path)
+
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+
+def download_and_extract_zip(url, dl_path, final_path, expected_size=None, expected_sha256=None):
+    start = time.perf_counter()
+    size = download_file(url, dl_path, expected_size=expected_size, expected_sha256=expected_sha256)
+    print_throughput("Downloaded", size, time.perf_counter() - start)
+
+    # Extract next to the current files, so a failed update keeps the old translations.
+    staging_path = os.path.normpath(final_path) + ".staging"
+    if os.path.exists(staging_path):
+        shutil.rmtree(staging_path)
+    os.makedirs(staging_path)
+
+    start = time.perf_counter()
+    size = extract_zip(dl_path, staging_path)
+    print_throughput("Extracted", size, time.perf_counter() - start)
+
+    # Forget the old manifest before touching the translations folder.
+    if os.path.exists(TL_MANIFEST_PATH):
+        os.remove(TL_MANIFEST_PATH)
+
+    swap_folder(staging_path, final_path)
+
+    with zipfile.ZipFile(dl_path, 'r') as zip_ref:
+        save_json(TL_MANIFEST_PATH, make_zip_manifest(zip_ref))
+
+class RangeRequestsNotSupportedException(Exception):
+    pass
+
+class HttpRangeFile:
+    # Read-only, seekable file over HTTP range requests.
+    # Lets zipfile read the central directory and single members of a remote zip.
+    def __init__(self, url, block_size=256 * 1024):
+        self.session = get_session()
+        self.block_size = block_size
+        self.pos = 0
+        self.buffer = b""
+        self.buffer_start = 0
+
+        # Presigned download urls may not allow HEAD, so request the first byte instead.
+        r = self.session.get(url, headers={'Range': 'bytes=0-0'})
+        r.raise_for_status()
+        if r.status_code != 206 or '/' not in r.headers.get('Content-Range', ''):
+            raise RangeRequestsNotSupportedException(f"Range requests not supported for {url}")
+
+        self.url = r.url
+        self.size = int(r.headers['Content-Range'].rsplit('/', 1)[1])
+        self.downloaded = 0
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            self.pos = offset
+        elif whence == 1:
+            self.pos += offset
+        elif whence == 2:
+            self.pos = self.size + offset
+        self.pos = max(0, min(self.pos, self.size))
+        return self.pos
+
+    def _fetch(self, start, end):
+        r = self.session.get(self.url, headers={'Range': f'bytes={start}-{end - 1}'})
+        r.raise_for_status()
+        if r.status_code != 206:
+            raise RangeRequestsNotSupportedException(f"Range request failed for {self.url}")
+        self.downloaded += len(r.content)
+        return r.content
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.pos
+        end = min(self.pos + size, self.size)
+
+        buffer_end = self.buffer_start + len(self.buffer)
+        if self.pos < self.buffer_start or end > buffer_end:
+            fetch_end = min(max(end, self.pos + self.block_size), self.size)
+            self.buffer = self._fetch(self.pos, fetch_end) if fetch_end > self.pos else b""
+            self.buffer_start = self.pos
+
+        data = self.buffer[self.pos - self.buffer_start:end - self.buffer_start]
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        self.buffer = b""
+
+def make_zip_manifest(zip_ref):
+    # The zip's central directory already holds the size and CRC32 of every member.
+    return {info.filename: [info.file_size, info.CRC] for info in zip_ref.infolist() if not info.is_dir()}
+
+# Above this fraction of the zip size, downloading the whole zip is cheaper.
+DELTA_MAX_FRACTION = 0.5
+
+def download_delta(url, final_path):
+    # Update the translations folder by only downloading changed files from the remote zip.
+    # Returns False if a full download is needed instead.
+    if not os.path.exists(TL_MANIFEST_PATH) or not os.path.exists(final_path):
+        return False
+
+    manifest = load_json(TL_MANIFEST_PATH)
+
+    start = time.perf_counter()
+    remote = HttpRangeFile(url)
+    try:
+        with zipfile.ZipFile(remote, 'r') as zip_ref:
+            new_manifest = make_zip_manifest(zip_ref)
+
+            changed = []
+            for info in zip_ref.infolist():
+                if info.is_dir():
+                    continue
+                local_path = get_zip_member_path(final_path, info.filename)
+                if manifest.get(info.filename) != new_manifest[info.filename] \
+                        or not os.path.exists(local_path) \
+                        or os.path.getsize(local_path) != info.file_size:
+                    changed.append(info)
+
+            removed = set(manifest) - set(new_manifest)
+
+            changed_size = sum(info.compress_size for info in changed)
+            if changed_size > remote.size * DELTA_MAX_FRACTION:
+                print(f"{len(changed)} files changed, downloading full update")
+                return False
+
+            print(f"Updating {len(changed)} files, removing {len(removed)} files")
+
+            # Manifest is written again once all files are up to date.
+            os.remove(TL_MANIFEST_PATH)
+
+            # Read members in zip order, so the read-ahead buffer gets reused.
+            changed.sort(key=lambda info: info.header_offset)
+            for info in tqdm(changed, desc="Updating"):
+                local_path = get_zip_member_path(final_path, info.filename)
+                os.makedirs(os.path.dirname(local_path), exist_ok=True)
+                tmp_path = local_path + ".tmp"
+                write_bytes(zip_ref.read(info), tmp_path)
+                os.replace(tmp_path, local_path)
+
+        for filename in removed:
+            local_path = get_zip_member_path(final_path, filename)
+            if os.path.exists(local_path):
+                os.remove(local_path)
+    finally:
+        remote.close()
+
+    save_json(TL_MANIFEST_PATH, new_manifest)
+    print_throughput("Downloaded changes:", remote.downloaded, time.perf_counter() - start)
+    return True
 
 def download_latest(ignore_filesize=False, prerelease=False):
     print("Downloading latest translation files")
@@ -381,29 +1124,30 @@ def download_latest(ignore_filesize=False, prerelease=False):
     if not dl_asset:
         raise Exception("No translations zip found")
     
+    print(f"Downloading {ver}")
+
+    try:
+        if download_delta(dl_asset['browser_download_url'], TL_PREFIX):
+            return ver
+    except Exception as e:
+        print(f"Partial update failed, downloading full update: {e}")
+
     if not ignore_filesize:
         # Check if we have enough space
         enough, err = check_enough_space(int(dl_asset['size']))
         if not enough:
             raise NotEnoughSpaceException(err)
-    
-    print(f"Downloading {ver}")
 
     os.makedirs(TMP_FOLDER, exist_ok=True)
     dl_path = os.path.join(TMP_FOLDER, dl_asset['name'])
 
-    download_file(dl_asset['browser_download_url'], dl_path)
-
-    final_path = TL_PREFIX
-    if os.path.exists(final_path):
-        print("Deleting old files")
-        shutil.rmtree(final_path)
-    os.makedirs(final_path, exist_ok=True)
-
-    print("Extracting")
+    # Newer GitHub API responses include a "sha256:..." digest of the asset.
+    expected_sha256 = None
+    digest = dl_asset.get('digest') or ""
+    if digest.startswith("sha256:"):
+        expected_sha256 = digest[len("sha256:"):]
 
-    with zipfile.ZipFile(dl_path, 'r') as zip_ref:
-        zip_ref.extractall(final_path)
+    download_and_extract_zip(dl_asset['browser_download_url'], dl_path, TL_PREFIX, int(dl_asset['size']), expected_sha256)
     
     shutil.rmtree(TMP_FOLDER)
 
@@ -411,9 +1155,10 @@ def download_latest(ignore_filesize=False, prerelease=False):
     return ver
 
 def clean_download():
+    # The translations themselves are kept for the next update.
     print("Removing temporary files")
-    if os.path.exists(TL_PREFIX):
-        shutil.rmtree(TL_PREFIX)
+    if os.path.exists(TMP_FOLDER):
+        shutil.rmtree(TMP_FOLDER)
     # print("Done")
 
 def tqdm(*args, **kwargs):
@@ -464,40 +1209,107 @@ def run_widget(widget, main=False, *args, **kwargs):
     APPLICATION.exec_()
     return
 
+LZ4_QUEUE_SIZE = 16
+WRITE_BUFFER_SIZE = 8 * 1024**2
+
+def _pipeline_stage(func, in_queue, out_queue, errors):
+    # Runs func on every item of in_queue until None is received.
+    try:
+        while True:
+            item = in_queue.get()
+            if item is None:
+                break
+            result = func(item)
+            if out_queue is not None:
+                out_queue.put(result)
+    except Exception as e:
+        errors.append(e)
+        # Keep draining, so the producer never blocks on a full queue.
+        while in_queue.get() is not None:
+            pass
+    finally:
+        if out_queue is not None:
+            out_queue.put(None)
+
 def download_lz4(url, mdb_path):
-    with requests.get(url, stream=True) as r:
-        r.raise_for_status()
-        lz4_context = lz4.frame.create_decompression_context()
-        with open(mdb_path, "wb") as f:
-            bar_format = TQDM_FORMAT + " {n_fmt}/{total_fmt}"
-            progress_bar = tqdm(total=int(r.headers.get('Content-Length', 0)), unit='B', unit_scale=True, desc=f"Downloading", bar_format=bar_format)
-            for chunk in r.iter_content(chunk_size=4096):
-                progress_bar.update(len(chunk))
-                chunk, _, _ = lz4.frame.decompress_chunk(lz4_context, chunk)
-                f.write(chunk)
+    # Network reader (this thread) -> lz4 decompressor -> buffered writer.
+    decompress_queue = queue.Queue(maxsize=LZ4_QUEUE_SIZE)
+    write_queue = queue.Queue(maxsize=LZ4_QUEUE_SIZE)
+    errors = []
+    times = {'decompress': 0.0}
+
+    lz4_context = lz4.frame.create_decompression_context()
+
+    def _decompress(chunk):
+        start = time.perf_counter()
+        chunk, _, _ = lz4.frame.decompress_chunk(lz4_context, chunk)
+        times['decompress'] += time.perf_counter() - start
+        return chunk
+
+    with open(mdb_path, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+        threads = [
+            threading.Thread(target=_pipeline_stage, args=(_decompress, decompress_queue, write_queue, errors)),
+            threading.Thread(target=_pipeline_stage, args=(f.write, write_queue, None, errors)),
+        ]
+        for thread in threads:
+            thread.start()
+
+        download_size = 0
+        start = time.perf_counter()
+        try:
+            with get_session().get(url, stream=True) as r:
+                r.raise_for_status()
+                bar_format = TQDM_FORMAT + " {n_fmt}/{total_fmt}"
+                progress_bar = tqdm(total=int(r.headers.get('Content-Length', 0)), unit='B', unit_scale=True, desc=f"Downloading", bar_format=bar_format)
+                for chunk in r.iter_content(chunk_size=LZ4_CHUNK_SIZE):
+                    if errors:
+                        break
+                    progress_bar.update(len(chunk))
+                    download_size += len(chunk)
+                    decompress_queue.put(chunk)
+                progress_bar.close()
+        finally:
+            download_time = time.perf_counter() - start
+            decompress_queue.put(None)
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            raise errors[0]
+
+        mdb_size = f.tell()
+
+    print_throughput("Downloaded", download_size, download_time)
+    print_throughput("Decompressed", mdb_size, times['decompress'])
+
+# Where game assets are downloaded from. Can be pointed at a local mirror.
+ASSET_BASE_URL = 'https://prd-storage-umamusume.akamaized.net/dl/resources/'
 
 def redownload_mdb():
     # Find the url of the latest mdb
-    with MetaConnection() as (conn, cursor):
-        cursor.execute("SELECT h FROM a WHERE n = 'master.mdb.lz4';")
-        row = cursor.fetchone()
+    asset_hash = get_meta_index().get_hash('master.mdb.lz4')
     
-    if not row:
+    if not asset_hash:
         raise Exception("master.mdb.lz4 not found in meta")
-    
-    asset_hash = row[0]
 
-    # Backup the existing mdb
     mdb_path = MDB_PATH
+    mdb_path_part = mdb_path + ".part"
     mdb_path_bak = f'{mdb_path}.{int(time.time())}.bak'
-    shutil.copy(mdb_path, mdb_path_bak)
 
-    # Download the mdb
-    url = 'https://prd-storage-umamusume.akamaized.net/dl/resources/Generic/{0:.2}/{0}'.format(asset_hash)
-    download_lz4(url, mdb_path)
+    # Download the mdb next to the existing one
+    url = ASSET_BASE_URL + 'Generic/{0:.2}/{0}'.format(asset_hash)
+    download_lz4(url, mdb_path_part)
+
+    # The existing mdb is moved to the backup instead of copied, as it is replaced anyway.
+    try:
+        os.replace(mdb_path, mdb_path_bak)
+    except OSError:
+        shutil.copy(mdb_path, mdb_path_bak)
+    os.replace(mdb_path_part, mdb_path)
+
     print("=== Downloaded latest master.mdb. You may now apply the patch again. ===")
 
-def download_asset(hash, no_progress=False, force=False):
+def download_asset(hash, no_progress=False, force=False, quiet=False, base_url=None):
     asset_path = get_asset_path(hash)
     if os.path.exists(asset_path):
         if force:
@@ -505,40 +1317,64 @@ def download_asset(hash, no_progress=False, force=False):
         else:
             return
     
-    print_str = f"Downloading asset {hash}"
-    if no_progress:
-        print_str = "\n" + print_str
-    
-    print(print_str)
+    if not quiet:
+        print_str = f"Downloading asset {hash}"
+        if no_progress:
+            print_str = "\n" + print_str
+        
+        print(print_str)
 
     os.makedirs(os.path.dirname(asset_path), exist_ok=True)
 
-    url = 'https://prd-storage-umamusume.akamaized.net/dl/resources/Windows/assetbundles/{0:.2}/{0}'.format(hash)
+    expected_size = get_meta_index().get_size(hash)
+
+    if not base_url:
+        base_url = ASSET_BASE_URL
+
+    url = base_url + 'Windows/assetbundles/{0:.2}/{0}'.format(hash)
     
     try:
-        download_file(url, asset_path, no_progress=no_progress)
+        download_file(url, asset_path, no_progress=no_progress, expected_size=expected_size)
     except requests.exceptions.HTTPError:
-        url = 'https://prd-storage-umamusume.akamaized.net/dl/resources/Generic/{0:.2}/{0}'.format(hash)
-        download_file(url, asset_path, no_progress=no_progress)
+        url = base_url + 'Generic/{0:.2}/{0}'.format(hash)
+        download_file(url, asset_path, no_progress=no_progress, expected_size=expected_size)
 
     # Mark the asset as downloaded in the meta db
-    with MetaConnection() as (conn, cursor):
-        cursor.execute("SELECT i FROM a WHERE h = ? AND s = 0", (hash,))
-        row = cursor.fetchone()
-        if not row:
-            return
-        cursor.execute("UPDATE a SET s = 1 WHERE i = ?", (row[0],))
-        conn.commit()
+    queue_meta_write('downloaded', hash)
+
+def get_missing_assets(asset_hashes):
+    # List each asset folder once instead of checking every file.
+    folders = {}
+    missing = []
+    for asset_hash in asset_hashes:
+        prefix = asset_hash[:2]
+        if prefix not in folders:
+            folder = os.path.join(DATA_PATH, prefix)
+            folders[prefix] = set(os.listdir(folder)) if os.path.isdir(folder) else set()
+        if asset_hash not in folders[prefix]:
+            missing.append(asset_hash)
+    return missing
+
+PREFETCH_WORKERS = 8
+
+def prefetch_assets(asset_hashes, workers=PREFETCH_WORKERS, base_url=None):
+    missing = get_missing_assets(sorted(set(asset_hashes)))
+    if not missing:
+        return
+
+    print(f"Downloading {len(missing)} missing assets")
+
+    def _download(asset_hash):
+        download_asset(asset_hash, no_progress=True, quiet=True, base_url=base_url)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(tqdm(executor.map(_download, missing), total=len(missing), desc="Downloading assets"))
 
 def prepare_font():
-    with MetaConnection() as (conn, cursor):
-        cursor.execute("SELECT h FROM a WHERE n = 'font/dynamic01.otf'")
-        row = cursor.fetchone()
+    font_hash = get_meta_index().get_hash('font/dynamic01.otf')
     
-    if not row:
+    if not font_hash:
         raise Exception("Font not found in meta db.")
-
-    font_hash = row[0]
     
     font_path = MDB_FOLDER_EDITING + "font/dynamic01.otf"
     os.makedirs(os.path.dirname(font_path), exist_ok=True)
@@ -641,11 +1477,11 @@ def add_nested_dict(d, path, value):
         d = d[key]
     d[path[-1]] = value
 
-def get_assets_type_dict():
+def get_assets_type_dict(workers=None):
     jsons = glob.glob(ASSETS_FOLDER + "\\**\\*.json", recursive=True)
     jsons += glob.glob(FLASH_FOLDER + "\\**\\*.json", recursive=True)
 
-    with UmaPool() as pool:
+    with UmaPool(workers) as pool:
         results = list(tqdm(pool.imap_unordered(get_asset_and_type, jsons, chunksize=128), total=len(jsons), desc="Looking for assets"))
 
     # asset_dict = {result[0]: result[1] for result in results if result[0]}
@@ -712,41 +1548,118 @@ def apply_colored_text(in_str, color_list):
 
     return in_str
 
-def make_diff(edited_bytes, source_bytes):
-    hasher = hashlib.sha256()
-    hasher.update(edited_bytes)
-    edited_hash = hasher.digest()
+# Padding is generated in blocks of this size. Must be a multiple of 4,
+# so the generated stream is the same as when done in one go.
+DIFF_BLOCK_SIZE = 16 * 1024**2
 
-    hasher = hashlib.sha256()
-    hasher.update(source_bytes)
-    source_hash = hasher.digest()
+def get_diff_padding_rng(data_hash):
+    # Data shorter than its diff is padded with random bytes seeded by its sha256 hash.
+    return np.random.default_rng(seed=int(data_hash, 16))
 
-    max_len = max(len(edited_bytes), len(source_bytes))
+def xor_padded_into(out, data):
+    # XOR data into the start of the uint8 array out, and its padding into the rest.
+    data_len = len(data)
+    np.bitwise_xor(out[:data_len], np.frombuffer(data, dtype='uint8'), out=out[:data_len])
 
-    gen = np.random.default_rng(seed=int(edited_hash.hex(), 16))
-    edited_bytes += gen.bytes(max_len - len(edited_bytes))
-    gen = np.random.default_rng(seed=int(source_hash.hex(), 16))
-    source_bytes += gen.bytes(max_len - len(source_bytes))
+    if len(out) > data_len:
+        gen = get_diff_padding_rng(hashlib.sha256(data).hexdigest())
+        for start in range(data_len, len(out), DIFF_BLOCK_SIZE):
+            block = out[start:start + DIFF_BLOCK_SIZE]
+            np.bitwise_xor(block, np.frombuffer(gen.bytes(len(block)), dtype='uint8'), out=block)
+
+def make_diff(edited_bytes, source_bytes):
+    diff = bytearray(max(len(edited_bytes), len(source_bytes)))
+    diff_array = np.frombuffer(diff, dtype='uint8')
 
-    diff = xor_bytes(edited_bytes, source_bytes)
+    xor_padded_into(diff_array, edited_bytes)
+    xor_padded_into(diff_array, source_bytes)
 
     return diff
 
-def apply_diff(source_bytes, diff):
+def apply_diff(source_bytes, diff, in_place=False):
+    # With in_place, diff must be writable (e.g. a bytearray) and is turned into the result.
     if len(diff) < len(source_bytes):
         raise Exception("Diff is smaller than source")
-    
-    delta_len = len(diff) - len(source_bytes)
 
-    if delta_len > 0:
-        hasher = hashlib.sha256()
-        hasher.update(source_bytes)
-        source_hash = hasher.digest()
+    out = diff if in_place else bytearray(diff)
+    xor_padded_into(np.frombuffer(out, dtype='uint8'), source_bytes)
+
+    return out
+
+def _map_array(f, size):
+    # Read-only uint8 view of a whole file, without reading it into memory.
+    if not size:
+        return None, np.empty(0, dtype='uint8')
+    file_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return file_map, np.frombuffer(file_map, dtype='uint8')
+
+def apply_diff_file(source_path, diff_path, out_path):
+    # Like apply_diff, but the files are memory-mapped and patched block by block,
+    # so memory use doesn't grow with the file size.
+    source_size = os.path.getsize(source_path)
+    diff_size = os.path.getsize(diff_path)
+
+    if diff_size < source_size:
+        raise Exception("Diff is smaller than source")
+
+    block = np.empty(DIFF_BLOCK_SIZE, dtype='uint8')
 
-        gen = np.random.default_rng(seed=int(source_hash.hex(), 16))
-        source_bytes += gen.bytes(delta_len)
+    with open(source_path, "rb") as source_file, open(diff_path, "rb") as diff_file, open(out_path, "wb") as out_file:
+        source_map, source_array = _map_array(source_file, source_size)
+        diff_map, diff_array = _map_array(diff_file, diff_size)
 
-    return xor_bytes(source_bytes, diff)
+        try:
+            for start in range(0, source_size, DIFF_BLOCK_SIZE):
+                end = min(start + DIFF_BLOCK_SIZE, source_size)
+                out = block[:end - start]
+                np.bitwise_xor(diff_array[start:end], source_array[start:end], out=out)
+                out_file.write(out)
+
+            if diff_size > source_size:
+                hasher = hashlib.sha256()
+                for start in range(0, source_size, DIFF_BLOCK_SIZE):
+                    hasher.update(source_array[start:start + DIFF_BLOCK_SIZE])
+                gen = get_diff_padding_rng(hasher.hexdigest())
+
+                for start in range(source_size, diff_size, DIFF_BLOCK_SIZE):
+                    end = min(start + DIFF_BLOCK_SIZE, diff_size)
+                    out = block[:end - start]
+                    np.bitwise_xor(diff_array[start:end], np.frombuffer(gen.bytes(end - start), dtype='uint8'), out=out)
+                    out_file.write(out)
+        finally:
+            # The maps can only be closed when no arrays point into them anymore.
+            source_array = diff_array = None
+            for file_map in (source_map, diff_map):
+                if file_map is not None:
+                    file_map.close()
+
+# Texture diffs made from raw RGBA pixels start with this header, followed by the
+# XOR diff of the pixel data. Diffs between two PNG files start with zeroes instead,
+# as both files begin with the same signature, so the two can't be mixed up.
+RGBA_DIFF_MAGIC = b"CRTRGBA1"
+RGBA_DIFF_HEADER = struct.Struct("<8sII")
+
+def is_rgba_diff(diff):
+    return diff[:len(RGBA_DIFF_MAGIC)] == RGBA_DIFF_MAGIC
+
+def make_rgba_diff(edited_image, source_image):
+    edited_image = edited_image.convert("RGBA")
+    header = RGBA_DIFF_HEADER.pack(RGBA_DIFF_MAGIC, *edited_image.size)
+    return header + make_diff(edited_image.tobytes(), source_image.convert("RGBA").tobytes())
+
+def apply_rgba_diff(source_image, diff):
+    _, width, height = RGBA_DIFF_HEADER.unpack_from(diff)
+    # A writable diff (e.g. a bytearray) is patched in place instead of copied.
+    body = memoryview(diff)[RGBA_DIFF_HEADER.size:]
+    new_bytes = apply_diff(source_image.convert("RGBA").tobytes(), body, in_place=not body.readonly)
+    return Image.frombuffer("RGBA", (width, height), memoryview(new_bytes)[:width * height * 4], "raw", "RGBA", 0, 1)
+
+def get_file_hash(path, chunk_size=1024**2):
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
 
 def read_bytes(path):
     with open(path, "rb") as f:
@@ -26,7 +26,7 @@ def check_update():
         # Don't check for updates if we're running as a script
         return
     
-    latest_release = util.fetch_latest_github_release('KevinVG207', 'Uma-Carotene-English-Patch', settings.prerelease)
+    latest_release = util.get_latest_release('KevinVG207', 'Uma-Carotene-English-Patch', settings.prerelease)
 
     latest_version = string_to_version(latest_release['tag_name'])
 